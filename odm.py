@@ -3,40 +3,60 @@
 """
 
 import argparse
+import concurrent.futures
 import os
 import logging
 import subprocess
-import time
+import threading
 import datetime
+import errno
 from agpypeline import entrypoint, algorithm
 from agpypeline.environment import Environment
 
 from configuration import ConfigurationOdm
 
 # Known image file extensions
-KNOWN_IMAGE_FILE_EXTS = ['.tif', '.tiff', '.jpg']
+KNOWN_IMAGE_FILE_EXTS = frozenset(['.tif', '.tiff', '.jpg'])
+
+# Known image file extensions as a tuple for use with str.endswith()
+KNOWN_IMAGE_FILE_SUFFIXES = tuple(sorted(KNOWN_IMAGE_FILE_EXTS))
 
 # Known additional acceptable files
-KNOWN_GCP_FILES = ['gcp_list.txt']
+KNOWN_GCP_FILES = frozenset(['gcp_list.txt'])
+
+# Known additional acceptable files as a sorted tuple for log messages
+KNOWN_GCP_FILES_SORTED = tuple(sorted(KNOWN_GCP_FILES))
+
+# Minimum number of images before linking them into the project folder is done in parallel
+PARALLEL_LINK_MIN_FILES = 64
+
+# Maximum number of threads used to link images into the project folder
+PARALLEL_LINK_MAX_WORKERS = 32
 
-# Paths and files available after processing
+# Path to the ODM working script
+WORKER_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)) or '.', 'worker.py')
+
+# Errors from creating a hard link that indicate a symbolic link should be used instead
+HARD_LINK_FALLBACK_ERRNOS = frozenset([errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP])
+
+# Paths and files available after processing, as folder names mapped to file names and their types
 RESULT_FILES = {
-    'odm_orthophoto': {'name': 'odm_orthophoto.tif', 'type': 'rgb'},
-    'odm_georeferencing': [
-        {'name': 'odm_georeferenced_model.laz', 'type': 'lidar'},
-        {'name': 'odm_georeferenced_model.bounds.shp', 'type': 'shapefile'},
-        {'name': 'odm_georeferenced_model.bounds.dbf', 'type': 'shapefile'},
-        {'name': 'odm_georeferenced_model.bounds.prj', 'type': 'shapefile'},
-        {'name': 'odm_georeferenced_model.bounds.shx', 'type': 'shapefile'},
-        {'name': 'proj.txt', 'type': 'shapefile'},
-        {'name': 'odm_georeferenced_model.bounds.geojson', 'type': 'shapefile'},
-        {'name': 'odm_georeferenced_model.boundary.json', 'type': 'shapefile'},
-    ],
-    'mve': {'name': 'mve_dense_point_cloud.ply', 'type': 'pointcloud'},
-    'odm_dem': [
-        {'name': 'dsm.tif', 'type': 'dsm'},
-        {'name': 'dtm.tif', 'type': 'dtm'},
-    ]
+    'odm_orthophoto': {'odm_orthophoto.tif': 'rgb'},
+    'odm_georeferencing': {
+        'odm_georeferenced_model.laz': 'lidar',
+        'odm_georeferenced_model.bounds.shp': 'shapefile',
+        'odm_georeferenced_model.bounds.dbf': 'shapefile',
+        'odm_georeferenced_model.bounds.prj': 'shapefile',
+        'odm_georeferenced_model.bounds.shx': 'shapefile',
+        'proj.txt': 'shapefile',
+        'odm_georeferenced_model.bounds.geojson': 'shapefile',
+        'odm_georeferenced_model.boundary.json': 'shapefile',
+    },
+    'mve': {'mve_dense_point_cloud.ply': 'pointcloud'},
+    'odm_dem': {
+        'dsm.tif': 'dsm',
+        'dtm.tif': 'dtm',
+    }
 }
 
 
@@ -61,13 +81,14 @@ class __internal__:
         # Iterate over a folder
         if os.path.isdir(path):
             logging.debug("Checking folder")
-            for one_path in os.listdir(path):
-                if not os.path.isdir(one_path):
-                    logging.debug("Checking file in folder (%s): %s", os.path.splitext(one_path)[1].lower(), one_path)
-                    if os.path.splitext(one_path)[1].lower() in KNOWN_IMAGE_FILE_EXTS:
-                        return True
+            with os.scandir(path) as entries:
+                for one_entry in entries:
+                    if not one_entry.is_dir():
+                        logging.debug("Checking file in folder: %s", one_entry.name)
+                        if one_entry.name.lower().endswith(KNOWN_IMAGE_FILE_SUFFIXES):
+                            return True
         else:
-            if os.path.splitext(path)[1].lower() in KNOWN_IMAGE_FILE_EXTS:
+            if path.lower().endswith(KNOWN_IMAGE_FILE_SUFFIXES):
                 return True
 
         return False
@@ -80,11 +101,76 @@ class __internal__:
         Return:
             Returns True if the file is acceptable
         """
-        logging.debug("Checking if %s is in %s", os.path.basename(path), str(KNOWN_GCP_FILES))
-        if os.path.basename(path) in KNOWN_GCP_FILES:
+        filename = os.path.basename(path)
+        logging.debug("Checking if %s is in %s", filename, KNOWN_GCP_FILES_SORTED)
+        if filename in KNOWN_GCP_FILES:
             return True
         return False
 
+    @staticmethod
+    def link_file(source, link_name, dir_fd=None, hard_link=True):
+        """Creates a hard link to the source file, falling back to a symbolic link when a hard link can't be made
+        Arguments:
+            source: the path of the file to link to
+            link_name: the path of the link to create
+            dir_fd: optional handle of the folder that link_name is relative to
+            hard_link: set to False to create a symbolic link without trying a hard link first
+        Return:
+            Returns True if a hard link was created and False if a symbolic link was created
+        """
+        if hard_link:
+            try:
+                os.link(source, link_name, dst_dir_fd=dir_fd)
+                return True
+            except OSError as ex:
+                if ex.errno not in HARD_LINK_FALLBACK_ERRNOS:
+                    raise
+                logging.debug("Unable to hard link '%s', using a symlink: %s", source, ex)
+        os.symlink(source, link_name, dir_fd=dir_fd)
+        return False
+
+    @staticmethod
+    def get_folder_files(folder_path):
+        """Returns the names of the files in a folder
+        Arguments:
+            folder_path: the path of the folder to read
+        Return:
+            Returns a set of the file names, or None if the folder can't be read
+        """
+        try:
+            with os.scandir(folder_path) as entries:
+                return {one_entry.name for one_entry in entries if one_entry.is_file()}
+        except OSError as ex:
+            logging.debug("Unable to read folder '%s': %s", folder_path, ex)
+        return None
+
+    @staticmethod
+    def find_project_files(files):
+        """Finds the image files and GCP file to process. Folders are only searched to a depth of 1
+        Arguments:
+            files: the list of files and folders to search
+        Return:
+            Returns a tuple containing the list of image files and the GCP file (None if one isn't found)
+        """
+        file_list = []
+        gcp_file = None
+        for one_file in files:
+            if os.path.isdir(one_file):
+                with os.scandir(one_file) as entries:
+                    for one_entry in entries:
+                        if not one_entry.is_dir():
+                            # Check the name directly since we already know this isn't a folder
+                            if one_entry.name.lower().endswith(KNOWN_IMAGE_FILE_SUFFIXES):
+                                file_list.append(one_entry.path)
+                            elif one_entry.name in KNOWN_GCP_FILES:
+                                gcp_file = one_entry.path
+            elif __internal__.check_for_image_file(one_file):
+                file_list.append(one_file)
+            elif __internal__.check_gcp_file(one_file):
+                gcp_file = one_file
+
+        return file_list, gcp_file
+
     @staticmethod
     def prepare_project_folder(files, default_folder):
         """Prepares the project folder
@@ -98,41 +184,52 @@ class __internal__:
         working_folder = default_folder
         logging.debug("Creating project folder at '%s'", working_folder)
         images_folder = os.path.join(working_folder, 'images')
-        if not os.path.exists(images_folder):
-            os.mkdir(images_folder)
+        os.makedirs(images_folder, exist_ok=True)
         logging.debug("Creating images folder at '%s'", images_folder)
 
         # Get the list of files to process
-        file_list = []
-        gcp_file = None
-        for one_file in files:
-            if os.path.isdir(one_file):
-                for file_name in os.listdir(one_file):
-                    if not os.path.isdir(file_name):
-                        if __internal__.check_for_image_file(file_name):
-                            file_list.append(os.path.join(one_file, file_name))
-                        elif __internal__.check_gcp_file(file_name):
-                            gcp_file = os.path.join(one_file, file_name)
-            elif __internal__.check_for_image_file(one_file):
-                file_list.append(one_file)
-            elif __internal__.check_gcp_file(one_file):
-                gcp_file = one_file
-
-        logging.debug("Found image files: %s", str(file_list))
-        for one_file in file_list:
+        file_list, gcp_file = __internal__.find_project_files(files)
+        logging.debug("Found image files: %s", file_list)
+
+        # Create the links relative to an open handle on the images folder to avoid resolving its path for each file
+        images_fd = os.open(images_folder, os.O_RDONLY | os.O_DIRECTORY)
+        log_links = logging.getLogger().isEnabledFor(logging.DEBUG)
+        use_hard_links = True
+
+        def link_image(one_file):
+            """Links the image file into the images folder
+            Arguments:
+                one_file: the path of the image file to link
+            Return:
+                Returns True if a hard link was created and False if a symbolic link was created
+            """
             filename = os.path.basename(one_file)
-            logging.debug("Linking file to image folder: '%s' ('%s')", filename, one_file)
-            ln_name = os.path.join(images_folder, filename)
-            logging.debug("symlink: '%s' to '%s'", one_file, ln_name)
-            os.symlink(one_file, ln_name)
+            if log_links:
+                logging.debug("link: '%s' to '%s' in '%s'", one_file, filename, images_folder)
+            return __internal__.link_file(one_file, filename, images_fd, use_hard_links)
 
-        logging.debug("Handling GCP file: %s", str(gcp_file))
+        try:
+            # Link the first image by itself to find out if hard links can be used for the rest. This
+            # avoids a failed hard link attempt for every file when they're not allowed
+            if file_list:
+                use_hard_links = link_image(file_list[0])
+            if len(file_list) < PARALLEL_LINK_MIN_FILES:
+                for one_file in file_list[1:]:
+                    link_image(one_file)
+            else:
+                # Overlap the filesystem latency of the link calls for large image sets
+                with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_LINK_MAX_WORKERS) as executor:
+                    list(executor.map(link_image, file_list[1:]))
+        finally:
+            os.close(images_fd)
+
+        logging.debug("Handling GCP file: %s", gcp_file)
         if gcp_file:
             filename = os.path.basename(gcp_file)
             logging.debug("Linking file to working folder: '%s' ('%s')", filename, gcp_file)
             ln_name = os.path.join(working_folder, filename)
-            logging.debug("symlink: '%s' to '%s'", gcp_file, ln_name)
-            os.symlink(gcp_file, ln_name)
+            logging.debug("link: '%s' to '%s'", gcp_file, ln_name)
+            __internal__.link_file(gcp_file, ln_name, hard_link=use_hard_links)
 
         return working_folder
 
@@ -142,21 +239,18 @@ class __internal__:
         Arguments:
             proc: the process to read from
         Notes:
-            Assumes the process was started with stdout being piped
+            Assumes the process was started with stdout being piped in text mode. Returns
+            when the process closes its output. If the output can't be read, the process is
+            killed so that it doesn't block on a full pipe while it's being waited on
         """
         try:
-            while True:
-                line = proc.stdout.readline()
-                if line:
-                    if isinstance(line, bytes):
-                        line = line.decode('UTF-8').strip()
-                    logging.debug(line.rstrip('\n'))
-                else:
-                    break
+            for line in proc.stdout:
+                logging.debug(line.rstrip('\n'))
         except Exception as ex:
-            logging.debug("Ignoring exception while waiting: %s", str(ex))
+            logging.warning("Stopping process after exception while reading its output: %s", ex)
             if logging.getLogger().level in [logging.INFO, logging.DEBUG]:
                 logging.exception(ex)
+            proc.kill()
 
     @staticmethod
     def run_stitch(project_path, override_path=None):
@@ -167,40 +261,30 @@ class __internal__:
             override_path: optional path to ODM override file
         """
         logging.debug('OpenDroneMap app beginning - %s', datetime.datetime.now().isoformat())
-        my_env = os.environ.copy()
-
-        # Set environment variables
-        my_env["ODM_PROJECT"] = project_path
+        # Set environment variables. Paths are made absolute since the worker runs in the project folder
+        project_path = os.path.abspath(project_path)
+        odm_env = {"ODM_PROJECT": project_path, "ODM_LOG_LEVEL": str(logging.getLogger().getEffectiveLevel())}
         if override_path:
             logging.debug("Override settings file at: %s", override_path)
-            my_env["ODM_SETTINGS"] = override_path
-
-        # Build up path to ODM working script
-        my_path = os.path.dirname(os.path.realpath(__file__))
-        if not my_path:
-            my_path = "."
-        script_path = os.path.join(my_path, "worker.py")
+            odm_env["ODM_SETTINGS"] = os.path.abspath(override_path)
+        my_env = {**os.environ, **odm_env}
 
         # Start the process
-        logging.info("Starting ODM script at: %s", script_path)
+        logging.info("Starting ODM script at: %s", WORKER_SCRIPT_PATH)
         # pylint: disable=consider-using-with
-        proc = subprocess.Popen([script_path, "code"], bufsize=-1, env=my_env,
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        proc = subprocess.Popen([WORKER_SCRIPT_PATH, "code"], bufsize=1, text=True, encoding='utf-8', errors='replace',
+                                env=my_env, cwd=project_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
         # Wait for the script to finish
         return_value = -1
         if proc:
-            # Loop here processing the output until the proc finishes
+            # Log the output on a separate thread while waiting for the proc to finish
             logging.info("Waiting for process to finish")
-            while proc.returncode is None:
-                if proc.stdout is not None:
-                    __internal__.consume_proc_output(proc)
-                    proc.poll()
-
-                # Sleep and try again for process to complete
-                time.sleep(1)
-            logging.debug("Return code: %s", str(proc.returncode))
-            return_value = proc.returncode
+            output_thread = threading.Thread(target=__internal__.consume_proc_output, args=(proc,), daemon=True)
+            output_thread.start()
+            return_value = proc.wait()
+            output_thread.join()
+            logging.debug("Return code: %s", return_value)
 
         logging.debug('OpenDroneMap app finished - %s', datetime.datetime.now().isoformat())
         return return_value
@@ -237,15 +321,22 @@ class Opendronemap(algorithm.Algorithm):
                 return (-1000, "OpenDroneMap overrides specified but file is not available: '%s'" %
                         environment.args.odm_overrides)
 
-        # Check that there's at least one image file in the list of files
-        for one_file in check_md['list_files']():
-            logging.debug("Checking if image file: %s", one_file)
-            if __internal__.check_for_image_file(one_file):
+        # Check that there's at least one image file in the list of files. Names are checked first
+        # so that folders are only searched when no image file is listed directly. A folder with an
+        # image file name is left to the folder search
+        files = list(check_md['list_files']())
+        for one_file in files:
+            if one_file.lower().endswith(KNOWN_IMAGE_FILE_SUFFIXES) and not os.path.isdir(one_file):
+                logging.debug("Found an image file")
+                return 0
+        for one_file in files:
+            logging.debug("Checking if image folder: %s", one_file)
+            if os.path.isdir(one_file) and __internal__.check_for_image_file(one_file):
                 logging.debug("Found an image file")
                 return 0
 
         return (-1001, "Unable to find an image file in files to process. Accepting files types: '%s'" %
-                ", ".join(KNOWN_IMAGE_FILE_EXTS))
+                ", ".join(sorted(KNOWN_IMAGE_FILE_EXTS)))
 
     def perform_process(self, environment: Environment, check_md: dict, transformer_md: dict,
                         full_md: list) -> dict:
@@ -263,21 +354,23 @@ class Opendronemap(algorithm.Algorithm):
         project_path = __internal__.prepare_project_folder(check_md['list_files'](), check_md['working_folder'])
 
         # Process the images
-        logging.debug("Calling ODM with project path: %s", str(project_path))
+        logging.debug("Calling ODM with project path: %s", project_path)
         stitch_code = __internal__.run_stitch(project_path, environment.args.odm_overrides)
 
         # Provide a list of returned files
         files_md = []
         for result_folder, result_files in RESULT_FILES.items():
             result_path = os.path.join(project_path, result_folder)
-            if isinstance(result_files, dict):
-                result_files = [result_files]
-            for one_file in result_files:
-                cur_path = os.path.join(result_path, one_file['name'])
-                if os.path.exists(cur_path):
+            # Read each folder once instead of checking for every expected file
+            found_files = __internal__.get_folder_files(result_path)
+            if found_files is None:
+                logging.debug("Skipping result folder '%s'", result_path)
+                continue
+            for file_name, file_type in result_files.items():
+                if file_name in found_files:
                     files_md.append({
-                        'path': cur_path,
-                        'key': one_file['type']
+                        'path': os.path.join(result_path, file_name),
+                        'key': file_type
                     })
 
         return {'file': files_md,
@@ -1,64 +1,76 @@
 #!/usr/bin/env python
 """Worker script for OpenDroneMap transformer
 """
+import logging
 import os
+import sys
 import yaml
 
-# Override pylint to allow us to set the settings path before importing the rest of ODM
-# pylint: disable=wrong-import-position
-# Override the default settings with our settings
+# Use the libyaml based loader when it's available
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
+# Override the default settings with our settings. This needs to happen before the rest of ODM is imported,
+# which is done in perform_work() once we know there's work to do
 from opendm import context
 
 context.settings_path = os.path.join(os.path.dirname(__file__), "settings.yaml")
-from opendm import config
-from stages.odm_app import ODMApp
-
-# pylint: enable=wrong-import-position
 
 # Forbidden OpenDroneMap setting overrides when using custom configuration
-NO_OVERRIDE_SETTINGS = ["project_path"]
+NO_OVERRIDE_SETTINGS = frozenset(["project_path"])
 
 
 def perform_work():
     """Prepares for and runs the ODM code
     """
-    print("[worker] Starting")
+    # Log at the same level as the transformer that started us
+    try:
+        log_level = int(os.environ.get('ODM_LOG_LEVEL', logging.INFO))
+    except ValueError:
+        log_level = logging.INFO
+    logging.basicConfig(level=log_level, format="[worker] %(message)s", stream=sys.stdout)
+    logging.info("Starting")
 
     arg_file = os.environ.get('ODM_SETTINGS')
     project_path = os.environ.get('ODM_PROJECT')
 
     if not project_path:
-        print("[worker] raising missing environment variable ODM_PROJECT")
+        logging.error("raising missing environment variable ODM_PROJECT")
         raise ValueError("Missing project path environment variable")
 
-    print("[worker] settings file: " + str(arg_file))
+    # Import the rest of ODM after the settings path is set and we know we're able to run
+    # pylint: disable=import-outside-toplevel
+    from opendm import config
+    from stages.odm_app import ODMApp
+
+    logging.info("settings file: %s", arg_file)
 
     new_settings = None
-    print("[worker] loading settings")
+    logging.debug("loading settings")
     if arg_file:
-        with open(arg_file, encoding='utf-8') as in_f:
-            new_settings = yaml.safe_load(in_f)
+        # Hand the loader the whole file as bytes so that it does the decoding itself
+        with open(arg_file, 'rb') as in_f:
+            new_settings = yaml.load(in_f.read(), Loader=YamlSafeLoader)
 
-    print("[worker] getting config using our settings: %s" % context.settings_path)
+    logging.debug("getting config using our settings: %s", context.settings_path)
     args = config.config()
 
-    print("[worker] merging config")
+    logging.debug("merging config")
     if new_settings:
-        for name in new_settings:
-            if name not in NO_OVERRIDE_SETTINGS:
-                setattr(args, name, new_settings[name])
-    print("[worker] config %s" % str(args))
+        vars(args).update({name: value for name, value in new_settings.items() if name not in NO_OVERRIDE_SETTINGS})
+    logging.debug("config %s", args)
 
-    print("[worker] setting project path")
+    logging.debug("setting project path")
     args.project_path = project_path
 
-    os.chdir(project_path)
-
-    print("[worker] Starting")
+    logging.info("Starting ODM")
     app = ODMApp(args=args)
     app.execute()
 
-    print("[worker] finishing")
+    logging.info("finishing")
 
 
-perform_work()
+if __name__ == "__main__":
+    perform_work()